@@ -1,38 +1,54 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import argparse
-from copy import deepcopy
+import errno
+import fcntl
 import json
+import multiprocessing
 import os
 import re
+import select
 import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 
-from curtin.block import iscsi, zfs
 from curtin import config
-from curtin import distro
 from curtin import util
 from curtin import paths
 from curtin import version
 from curtin.log import LOG, logged_time
-from curtin.reporter.legacy import load_reporter
 from curtin.reporter import events
 from . import populate_one_subcmd
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 INSTALL_LOG = "/var/log/curtin/install.log"
 # Upon error, curtin creates a tar of all related logs at ERROR_TARFILE
 ERROR_TARFILE = '/var/log/curtin/curtin-error-logs.tar'
 SAVE_INSTALL_LOG = '/root/curtin-install.log'
 SAVE_INSTALL_CONFIG = '/root/curtin-install-cfg.yaml'
+# size of the blocks in which stage command output is read
+READ_SIZE = 65536
+
+# (logfile, size, mtime) of install logs already copied, to the copy path
+_COPIED_LOGS = {}
 
 INSTALL_START_MSG = ("curtin: Installation started. (%s)" %
                      version.version_string())
 INSTALL_PASS_MSG = "curtin: Installation finished."
 INSTALL_FAIL_MSG = "curtin: Installation failed with exception: {exception}"
 
+POWER_DELAY_MINUTES_REGEX = re.compile(r'\+[0-9]+')
+GRUB_DEFAULT_REGEX = re.compile(r'\bset default="([0-9]+)"')
+GRUB_MENU_ITEM_REGEX = re.compile(r'^\s*(menuentry|submenu)\b')
+GRUB_VARIABLE_REGEX = re.compile(r'\$\{[^}]*\}')
+
 STAGE_DESCRIPTIONS = {
     'early': 'preparing for installation',
     'partitioning': 'configuring storage',
@@ -60,11 +76,38 @@ CONFIG_BUILTIN = {
 }
 
 
+def builtin_config():
+    """Return a copy of CONFIG_BUILTIN that is safe to merge into.
+
+    CONFIG_BUILTIN is at most a dict of dicts of lists, so copying those
+    containers is enough; no need for a full deepcopy.
+    """
+    cfg = {}
+    for key, val in CONFIG_BUILTIN.items():
+        if isinstance(val, dict):
+            val = dict((k, list(v) if isinstance(v, list) else v)
+                       for k, v in val.items())
+        elif isinstance(val, list):
+            val = list(val)
+        cfg[key] = val
+    return cfg
+
+
 def clear_install_log(logfile):
-    """Clear the installation log, so no previous installation is present."""
+    """Clear the installation log, so no previous installation is present.
+
+    The previous log is renamed to logfile.prev rather than truncated, so
+    that anything still reading it keeps a valid file.
+    """
     util.ensure_dir(os.path.dirname(logfile))
     try:
-        open(logfile, 'w').close()
+        try:
+            os.rename(logfile, logfile + '.prev')
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.close(os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o666))
     except Exception:
         pass
 
@@ -79,12 +122,34 @@ def copy_install_log(logfile, target, log_target_path):
         LOG.warn(basemsg + "  file does not exist.")
         return
 
+    target_log = paths.target_path(target, log_target_path)
+    st = os.stat(logfile)
+    key = (logfile, st.st_size, st.st_mtime)
+    if _COPIED_LOGS.get(key) == target_log and os.path.isfile(target_log):
+        LOG.debug('Curtin install log %s already copied to target/%s',
+                  logfile, log_target_path)
+        return
+
     LOG.debug('Copying curtin install log from %s to target/%s',
               logfile, log_target_path)
-    util.write_file(
-        filename=paths.target_path(target, log_target_path),
-        content=util.load_file(logfile, decode=False),
-        mode=0o400, omode="wb")
+    util.ensure_dir(os.path.dirname(target_log))
+    shutil.copyfile(logfile, target_log)
+    os.chmod(target_log, 0o400)
+    _COPIED_LOGS[key] = target_log
+
+
+def write_all(fp, data):
+    """Write all of data to the unbuffered file fp.
+
+    A raw file write is a single write(2) and may write only part of the
+    data, so retry with the remainder until it has all been written.
+    """
+    while data:
+        written = fp.write(data)
+        if written is None:
+            # python2 file objects write everything or raise
+            return
+        data = data[written:]
 
 
 def writeline_and_stdout(logfile, message):
@@ -99,9 +164,12 @@ def writeline_and_stdout(logfile, message):
 
 
 def writeline(fname, output):
-    """Write a line to a file."""
+    """Write a line to a file, given its path or an open InstallLog."""
     if not output.endswith('\n'):
         output += '\n'
+    if isinstance(fname, InstallLog):
+        fname.write(output)
+        return
     try:
         with open(fname, 'a') as fp:
             fp.write(output)
@@ -109,6 +177,55 @@ def writeline(fname, output):
         pass
 
 
+class InstallLog(object):
+    """The install log, held open for appending for the whole install."""
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+        self.fp = None
+        if not logfile:
+            return
+        try:
+            self.fp = open(logfile, 'ab', 0)
+        except IOError:
+            pass
+
+    def write(self, output):
+        if self.fp is None:
+            return
+        # python2 messages are already byte strings
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8', 'replace')
+        try:
+            write_all(self.fp, output)
+        except IOError:
+            pass
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+def dump_json(data):
+    """Return data encoded as json bytes, using orjson if available.
+
+    orjson is told to convert non-string keys and to reject dates and
+    times as json.dumps does, so the result does not depend on whether
+    orjson is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=(orjson.OPT_NON_STR_KEYS |
+                                          orjson.OPT_PASSTHROUGH_DATETIME))
+    return json.dumps(data).encode()
+
+
 class WorkingDir(object):
     def __init__(self, config):
         top_d = tempfile.mkdtemp()
@@ -126,7 +243,7 @@ class WorkingDir(object):
             raise ValueError(
                 "Unable to create target directory '%s': %s" %
                 (target_d, e))
-        if os.listdir(target_d) != []:
+        if not util.dir_is_empty(target_d):
             raise ValueError(
                 "Provided target dir '%s' was not empty." % target_d)
 
@@ -136,13 +253,15 @@ class WorkingDir(object):
         config_f = os.path.join(state_d, 'config')
         fstab_f = os.path.join(state_d, 'fstab')
 
-        with open(config_f, "w") as fp:
-            json.dump(config, fp)
+        # always written: besides user commands that read $CONFIG, every
+        # curtin subcommand run by a stage (including the builtin extract,
+        # block-meta and curthooks) loads its config from this file.
+        with open(config_f, "wb") as fp:
+            fp.write(dump_json(config))
 
         # just touch these files to make sure they exist
-        for f in (config_f, fstab_f, netconf_f, netstate_f):
-            with open(f, "ab") as fp:
-                pass
+        for f in (fstab_f, netconf_f, netstate_f):
+            os.close(os.open(f, os.O_WRONLY | os.O_CREAT, 0o666))
 
         self.scratch = scratch_d
         self.target = target_d
@@ -165,10 +284,12 @@ class WorkingDir(object):
 
 class Stage(object):
 
-    def __init__(self, name, commands, env, reportstack=None, logfile=None):
+    def __init__(self, name, commands, env, reportstack=None, logfile=None,
+                 parallel=False):
         self.name = name
         self.commands = commands
         self.env = env
+        self.parallel = parallel
         if logfile is None:
             logfile = INSTALL_LOG
         self.install_log = self._open_install_log(logfile)
@@ -185,11 +306,11 @@ class Stage(object):
         self.reportstack = reportstack
 
     def _open_install_log(self, logfile):
-        """Open the install log."""
+        """Open the install log, unbuffered as output is written in blocks."""
         if not logfile:
             return None
         try:
-            return open(logfile, 'ab')
+            return open(logfile, 'ab', 0)
         except IOError:
             return None
 
@@ -205,47 +326,130 @@ class Stage(object):
         """Write data to stdout and to the install_log."""
         self.write_stdout(data)
         if self.install_log is not None:
-            self.install_log.write(data)
-            self.install_log.flush()
+            write_all(self.install_log, data)
+
+    def _read_output(self, sp, write):
+        """Pass output of sp to write until the pipe closes and return it all.
+
+        Output is read in blocks rather than a byte at a time.  Like the
+        previous byte at a time read, this waits for end of file on the
+        pipe, so output of background processes started by the command
+        that still hold the pipe open is read too.
+        """
+        fd = sp.stdout.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        chunks = []
+        while True:
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([fd], [], [], 0.1)
+                continue
+            if not data:
+                break
+            write(data)
+            chunks.append(data)
+
+        sp.stdout.close()
+        sp.wait()
+        return b"".join(chunks)
+
+    def _run_command(self, cmdname, cmd, write, env):
+        """Run a single stage command, passing its output to write.
+
+        CURTIN_REPORTSTACK is set in env only while the command is started
+        and then restored, so env is not copied for every command.
+        """
+        cur_res = events.ReportEventStack(
+            name=cmdname, description="running '%s'" % ' '.join(cmd),
+            parent=self.reportstack, level="DEBUG")
+
+        shell = not isinstance(cmd, list)
+        with util.LogTimer(LOG.debug, cmdname):
+            with cur_res:
+                prev_reportstack = env.get('CURTIN_REPORTSTACK')
+                env['CURTIN_REPORTSTACK'] = cur_res.fullname
+                try:
+                    sp = subprocess.Popen(
+                        cmd, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        env=env, shell=shell)
+                except OSError as e:
+                    LOG.warn("%s command failed", cmdname)
+                    raise util.ProcessExecutionError(cmd=cmd, reason=e)
+                finally:
+                    if prev_reportstack is None:
+                        del env['CURTIN_REPORTSTACK']
+                    else:
+                        env['CURTIN_REPORTSTACK'] = prev_reportstack
+
+                output = self._read_output(sp, write)
+                rc = sp.returncode
+                if rc != 0:
+                    LOG.warn("%s command failed", cmdname)
+                    raise util.ProcessExecutionError(
+                        stdout=output, stderr="",
+                        exit_code=rc, cmd=cmd)
+
+    def _run_parallel(self, cmdnames):
+        """Run the named commands concurrently.
+
+        Each command's output is buffered and written out in cmdnames
+        order once all commands have finished, so the install log reads
+        the same as for a sequential run.  The first failure in that
+        order is raised once all output has been written, and any other
+        failures are logged.
+        """
+        pending = list(reversed(cmdnames))
+        pending_lock = threading.Lock()
+        outputs = dict((cmdname, []) for cmdname in cmdnames)
+        errors = {}
+
+        def worker():
+            while True:
+                with pending_lock:
+                    if not pending:
+                        return
+                    cmdname = pending.pop()
+                try:
+                    # concurrent commands each need their own env
+                    self._run_command(cmdname, self.commands[cmdname],
+                                      outputs[cmdname].append,
+                                      self.env.copy())
+                except Exception as e:
+                    errors[cmdname] = e
+
+        nworkers = min(len(cmdnames), multiprocessing.cpu_count())
+        threads = [threading.Thread(target=worker) for _ in range(nworkers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for cmdname in cmdnames:
+            for data in outputs[cmdname]:
+                self.write(data)
+
+        failed = [cmdname for cmdname in cmdnames if cmdname in errors]
+        for cmdname in failed[1:]:
+            LOG.warn("%s command also failed: %s", cmdname, errors[cmdname])
+        if failed:
+            raise errors[failed[0]]
 
     def run(self):
-        for cmdname in sorted(self.commands.keys()):
-            cmd = self.commands[cmdname]
-            if not cmd:
-                continue
-            cur_res = events.ReportEventStack(
-                name=cmdname, description="running '%s'" % ' '.join(cmd),
-                parent=self.reportstack, level="DEBUG")
-
-            env = self.env.copy()
-            env['CURTIN_REPORTSTACK'] = cur_res.fullname
-
-            shell = not isinstance(cmd, list)
-            with util.LogTimer(LOG.debug, cmdname):
-                with cur_res:
-                    try:
-                        sp = subprocess.Popen(
-                            cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            env=env, shell=shell)
-                    except OSError as e:
-                        LOG.warn("%s command failed", cmdname)
-                        raise util.ProcessExecutionError(cmd=cmd, reason=e)
-
-                    output = b""
-                    while True:
-                        data = sp.stdout.read(1)
-                        if not data and sp.poll() is not None:
-                            break
-                        self.write(data)
-                        output += data
-
-                    rc = sp.returncode
-                    if rc != 0:
-                        LOG.warn("%s command failed", cmdname)
-                        raise util.ProcessExecutionError(
-                            stdout=output, stderr="",
-                            exit_code=rc, cmd=cmd)
+        cmdnames = [cmdname for cmdname in sorted(self.commands.keys())
+                    if self.commands[cmdname]]
+        if self.parallel and len(cmdnames) > 1:
+            self._run_parallel(cmdnames)
+            return
+
+        for cmdname in cmdnames:
+            self._run_command(cmdname, self.commands[cmdname], self.write,
+                              self.env)
 
 
 def apply_power_state(pstate):
@@ -289,7 +493,7 @@ def load_power_state(pstate):
     delay = pstate.get("delay", "5")
     if delay == "now":
         delay = "0"
-    elif re.match(r"\+[0-9]+", str(delay)):
+    elif POWER_DELAY_MINUTES_REGEX.match(str(delay)):
         delay = "%sm" % delay[1:]
     else:
         delay = str(delay)
@@ -311,64 +515,72 @@ def apply_kexec(kexec, target):
     kexec:
      mode: on
     """
-    grubcfg = "boot/grub/grub.cfg"
-    target_grubcfg = os.path.join(target, grubcfg)
-
-    if kexec is None or kexec.get("mode") != "on":
+    if kexec is None:
         return False
 
     if not isinstance(kexec, dict):
         raise TypeError("kexec is not a dict.")
 
-    if not util.which('kexec'):
-        distro.install_packages('kexec-tools')
+    if kexec.get("mode") != "on":
+        return False
 
+    grubcfg = "boot/grub/grub.cfg"
+    target_grubcfg = os.path.join(target, grubcfg)
     if not os.path.isfile(target_grubcfg):
         raise ValueError("%s does not exist in target" % grubcfg)
 
-    with open(target_grubcfg, "r") as fp:
-        default = 0
-        menu_lines = []
-
-        # get the default grub boot entry number and menu entry line numbers
-        for line_num, line in enumerate(fp, 1):
-            if re.search(r"\bset default=\"[0-9]+\"\b", " %s " % line):
-                default = int(re.sub(r"[^0-9]", '', line))
-            if re.search(r"\bmenuentry\b", " %s " % line):
-                menu_lines.append(line_num)
-
-        if not menu_lines:
-            LOG.error("grub config file does not have a menuentry\n")
-            return False
-
-        # get the begin and end line numbers for default menuentry section,
-        # using end of file if it's the last menuentry section
-        begin = menu_lines[default]
-        if begin != menu_lines[-1]:
-            end = menu_lines[default + 1] - 1
-        else:
-            end = line_num
+    if not util.which('kexec'):
+        from curtin import distro
+        distro.install_packages('kexec-tools')
 
-        fp.seek(0)
-        lines = fp.readlines()
-        kernel = append = initrd = ""
+    # get the default grub boot entry number and, for each top level
+    # menuentry or submenu (grub only numbers those), the lines of its own
+    # block that may name its kernel or initrd
+    default = 0
+    entries = []
+    depth = 0
+    with open(target_grubcfg, "r") as fp:
+        for line in fp:
+            match = GRUB_DEFAULT_REGEX.search(line)
+            if match:
+                default = int(match.group(1))
+            if depth == 0 and GRUB_MENU_ITEM_REGEX.search(line):
+                entries.append([])
+            elif depth == 1 and entries and (
+                    'linux' in line or 'initrd' in line):
+                entries[-1].append(line)
+            if not line.lstrip().startswith('#'):
+                line = GRUB_VARIABLE_REGEX.sub('', line)
+                depth = max(0, depth + line.count('{') - line.count('}'))
+
+    if not entries:
+        LOG.error("grub config file does not have a menuentry\n")
+        return False
 
-        for i in range(begin, end):
-            if 'linux' in lines[i].split():
-                split_line = shlex.split(lines[i])
-                kernel = os.path.join(target, split_line[1])
-                append = "--append=" + ' '.join(split_line[2:])
-            if 'initrd' in lines[i].split():
-                split_line = shlex.split(lines[i])
-                initrd = "--initrd=" + os.path.join(target, split_line[1])
+    if default >= len(entries):
+        # grub itself falls back to the first entry
+        LOG.warn("grub default entry %s does not exist, using entry 0",
+                 default)
+        default = 0
 
-        if not kernel:
-            LOG.error("grub config file does not have a kernel\n")
-            return False
+    kernel = append = initrd = ""
+    for line in entries[default]:
+        words = line.split()
+        if 'linux' in words:
+            split_line = shlex.split(line)
+            kernel = os.path.join(target, split_line[1])
+            append = "--append=" + ' '.join(split_line[2:])
+        if 'initrd' in words:
+            split_line = shlex.split(line)
+            initrd = "--initrd=" + os.path.join(target, split_line[1])
+
+    if not kernel:
+        LOG.error("grub config file does not have a kernel\n")
+        return False
 
-        LOG.debug("kexec -l %s %s %s" % (kernel, append, initrd))
-        util.subp(args=['kexec', '-l', kernel, append, initrd])
-        return True
+    LOG.debug("kexec -l %s %s %s" % (kernel, append, initrd))
+    util.subp(args=['kexec', '-l', kernel, append, initrd])
+    return True
 
 
 def migrate_proxy_settings(cfg):
@@ -392,19 +604,32 @@ def migrate_proxy_settings(cfg):
     cfg['proxy'] = proxy
 
 
+def add_cmdline_sources(cfg, sources):
+    """Add sources given on the command line to cfg['sources'].
+
+    They are numbered after the configured sources, zero padded wide
+    enough that they still sort in order with more than 100 sources.
+    """
+    offset = len(cfg['sources'])
+    width = max(2, len(str(offset + len(sources) - 1)))
+    for i, source in enumerate(sources, offset):
+        cfg['sources']["%0*d_cmdline" % (width, i)] = (
+            util.sanitize_source(source))
+
+
 @logged_time("INSTALL_COMMAND")
 def cmd_install(args):
+    from curtin.block import iscsi, zfs
+    from curtin.reporter.legacy import load_reporter
     from .collect_logs import create_log_tarfile
-    cfg = deepcopy(CONFIG_BUILTIN)
+    cfg = builtin_config()
     config.merge_config(cfg, args.config)
 
-    for source in args.source:
-        src = util.sanitize_source(source)
-        cfg['sources']["%02d_cmdline" % len(cfg['sources'])] = src
+    add_cmdline_sources(cfg, args.source)
 
     LOG.info(INSTALL_START_MSG)
     LOG.debug('LANG=%s', os.environ.get('LANG'))
-    LOG.debug("merged config: %s" % cfg)
+    LOG.debug("merged config: %s", cfg)
     if not len(cfg.get('sources', [])):
         raise util.BadUsage("no sources provided to install")
 
@@ -417,6 +642,10 @@ def cmd_install(args):
     logfile = instcfg.get('log_file')
     error_tarfile = instcfg.get('error_tarfile')
     post_files = instcfg.get('post_files', [logfile])
+    parallel_stages = instcfg.get('parallel_commands') or []
+    if not isinstance(parallel_stages, list):
+        raise ValueError("'install/parallel_commands' in config is not a "
+                         "list of stage names: %s" % parallel_stages)
 
     # Generate curtin configuration dump and add to write_files unless
     # installation config disables dump
@@ -436,7 +665,8 @@ def cmd_install(args):
     legacy_reporter = load_reporter(cfg)
     legacy_reporter.files = post_files
 
-    writeline_and_stdout(logfile, INSTALL_START_MSG)
+    install_log = InstallLog(logfile)
+    writeline_and_stdout(install_log, INSTALL_START_MSG)
     args.reportstack.post_files = post_files
     workingd = None
     try:
@@ -450,7 +680,9 @@ def cmd_install(args):
         env.update(workingd.env())
 
         for name in cfg.get('stages'):
-            desc = STAGE_DESCRIPTIONS.get(name, "stage %s" % name)
+            desc = STAGE_DESCRIPTIONS.get(name)
+            if desc is None:
+                desc = "stage %s" % name
             reportstack = events.ReportEventStack(
                 "stage-%s" % name, description=desc,
                 parent=args.reportstack)
@@ -460,24 +692,26 @@ def cmd_install(args):
                 commands_name = '%s_commands' % name
                 with util.LogTimer(LOG.debug, 'stage_%s' % name):
                     stage = Stage(name, cfg.get(commands_name, {}), env,
-                                  reportstack=reportstack, logfile=logfile)
+                                  reportstack=reportstack, logfile=logfile,
+                                  parallel=name in parallel_stages)
                     stage.run()
 
         if apply_kexec(cfg.get('kexec'), workingd.target):
             cfg['power_state'] = {'mode': 'reboot', 'delay': 'now',
                                   'message': "'rebooting with kexec'"}
 
-        writeline_and_stdout(logfile, INSTALL_PASS_MSG)
+        writeline_and_stdout(install_log, INSTALL_PASS_MSG)
         legacy_reporter.report_success()
     except Exception as e:
         exp_msg = INSTALL_FAIL_MSG.format(exception=e)
-        writeline(logfile, exp_msg)
+        writeline(install_log, exp_msg)
         LOG.error(exp_msg)
         legacy_reporter.report_failure(exp_msg)
         if error_tarfile:
             create_log_tarfile(error_tarfile, cfg)
         raise e
     finally:
+        install_log.close()
         log_target_path = instcfg.get('save_install_log', SAVE_INSTALL_LOG)
         if log_target_path and workingd:
             copy_install_log(logfile, workingd.target, log_target_path)
@@ -502,7 +736,7 @@ def cmd_install(args):
             #
             # Check if storage configuration has iscsi volumes and if so ensure
             # iscsi service is active before exiting install
-            if iscsi.get_iscsi_disks_from_config(cfg):
+            if iscsi.get_iscsi_volumes_from_config(cfg):
                 iscsi.restart_iscsi_service()
 
             for pool in zfs.get_zpool_from_config(cfg):
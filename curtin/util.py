@@ -617,6 +617,22 @@ def ensure_dir(path, mode=None):
         os.chmod(path, mode)
 
 
+def dir_is_empty(path):
+    """Return True if directory path has no entries.
+
+    Stops at the first entry rather than listing the whole directory."""
+    if not hasattr(os, 'scandir'):
+        # python2
+        return not os.listdir(path)
+    entries = os.scandir(path)
+    try:
+        return next(entries, None) is None
+    finally:
+        # os.scandir iterators only have close() from python3.6
+        if hasattr(entries, 'close'):
+            entries.close()
+
+
 def write_file(filename, content, mode=0o644, omode="w"):
     """
     write 'content' to file at 'filename' using python open mode 'omode'.
@@ -1,11 +1,17 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from unittest import skipIf
 import copy
+import datetime
+import json
 import mock
+import os
+import textwrap
 
 from curtin import config
 from curtin.commands import install
-from curtin.util import BadUsage, ensure_dir, write_file
+from curtin.util import (
+    BadUsage, ProcessExecutionError, ensure_dir, load_file, write_file)
 from .helpers import CiTestCase
 from collections import namedtuple
 
@@ -39,6 +45,46 @@ class TestMigrateProxy(CiTestCase):
         self.assertEqual(expected, cfg)
 
 
+class TestBuiltinConfig(CiTestCase):
+
+    def test_builtin_config_matches_builtin(self):
+        """builtin_config returns a copy equal to CONFIG_BUILTIN."""
+        self.assertEqual(install.CONFIG_BUILTIN, install.builtin_config())
+
+    def test_builtin_config_changes_do_not_leak(self):
+        """Modifying builtin_config result does not alter CONFIG_BUILTIN."""
+        expected = copy.deepcopy(install.CONFIG_BUILTIN)
+        cfg = install.builtin_config()
+        cfg['sources']['00_cmdline'] = 'http://example.com/root.tgz'
+        cfg['stages'].append('extra')
+        cfg['late_commands']['builtin'].append('true')
+        cfg['install']['log_file'] = '/tmp/my.log'
+        self.assertEqual(expected, install.CONFIG_BUILTIN)
+
+
+class TestAddCmdlineSources(CiTestCase):
+
+    def test_sources_numbered_after_config_sources(self):
+        """Command line sources are numbered after configured sources."""
+        cfg = {'sources': {'10_config': {'type': 'tgz', 'uri': 'a.tgz'}}}
+        install.add_cmdline_sources(cfg, ['b.tgz', 'dd-raw:c.img'])
+        self.assertEqual(
+            {'10_config': {'type': 'tgz', 'uri': 'a.tgz'},
+             '01_cmdline': {'type': 'tgz', 'uri': 'b.tgz'},
+             '02_cmdline': {'type': 'dd-raw', 'uri': 'c.img'}},
+            cfg['sources'])
+
+    def test_many_sources_sort_in_order(self):
+        """Over 100 command line sources still sort in given order."""
+        cfg = {'sources': {}}
+        sources = ['%d.tgz' % i for i in range(105)]
+        install.add_cmdline_sources(cfg, sources)
+        self.assertIn('000_cmdline', cfg['sources'])
+        self.assertEqual(
+            sources,
+            [cfg['sources'][k]['uri'] for k in sorted(cfg['sources'])])
+
+
 class TestCmdInstall(CiTestCase):
 
     def setUp(self):
@@ -66,6 +112,19 @@ class TestCmdInstall(CiTestCase):
             "'proxy' in config is not a dictionary: junk",
             str(context_manager.exception))
 
+    def test_error_parallel_commands_not_a_list(self):
+        """An error is raised when parallel_commands is not a list."""
+        myargs = FakeArgs(
+            config={'install': {'log_file': self.logfile,
+                                'parallel_commands': 'curthooks'}},
+            source=['https://cloud-images.ubuntu.com/some.tar.gz'],
+            reportstack=None)
+        with self.assertRaises(ValueError) as context_manager:
+            install.cmd_install(myargs)
+        self.assertEqual(
+            "'install/parallel_commands' in config is not a list of stage "
+            "names: curthooks", str(context_manager.exception))
+
     def test_curtin_error_unmount_doesnt_lose_exception(self):
         """Confirm unmount:disable skips unmounting, keeps exception"""
         working_dir = self.tmp_path('working', _dir=self.new_root)
@@ -94,6 +153,38 @@ class TestCmdInstall(CiTestCase):
         self.assertEqual(0, self.m_umount.call_count)
         self.assertEqual(1, self.m_copy_log.call_count)
 
+    def test_curtin_error_unmount_restarts_iscsi_exports_zpools(self):
+        """On unmount, iscsi is restarted and zpools are exported."""
+        working_dir = self.tmp_path('working', _dir=self.new_root)
+        ensure_dir(working_dir)
+        storage = {'version': 1, 'config': [
+            {'id': 'sda', 'type': 'disk',
+             'path': 'iscsi:192.168.1.1::3260:1:iqn.2017-04.com.example:a'},
+            {'id': 'pool1', 'type': 'zpool', 'pool': 'rpool1'}]}
+        myargs = FakeArgs(
+            config={'install': {'log_file': self.logfile},
+                    'storage': storage},
+            source=['dd-raw:https://localhost/raw_images/centos-6-3.img',
+                    'dd-raw:https://localhost/cant/provide/two/images.img'],
+            reportstack=FakeReportStack())
+        self.add_patch(
+            'curtin.commands.collect_logs.create_log_tarfile', 'm_tar')
+        self.add_patch(
+            'curtin.commands.install.copy_install_log', 'm_copy_log')
+        self.add_patch(
+            'curtin.commands.install.tempfile.mkdtemp', 'm_mkdtemp')
+        self.add_patch('curtin.util.do_umount', 'm_umount')
+        self.add_patch('curtin.block.iscsi.restart_iscsi_service',
+                       'm_restart_iscsi')
+        self.add_patch('curtin.block.zfs.zpool_export', 'm_zpool_export')
+        self.m_mkdtemp.return_value = working_dir
+        with self.assertRaises(ValueError):
+            install.cmd_install(myargs)
+        self.assertEqual(1, self.m_umount.call_count)
+        self.assertEqual(1, self.m_restart_iscsi.call_count)
+        self.assertEqual([mock.call('rpool1')],
+                         self.m_zpool_export.call_args_list)
+
     def test_curtin_error_copies_config_and_error_tarfile_defaults(self):
         """On curtin error, install error_tarfile is created with all logs.
 
@@ -191,6 +282,148 @@ class TestCmdInstall(CiTestCase):
             self.m_copy_log.call_args_list)
 
 
+class TestClearInstallLog(CiTestCase):
+
+    def test_clear_install_log_keeps_previous(self):
+        """clear_install_log empties the log, keeping the old one as .prev"""
+        logfile = self.tmp_path('install.log')
+        write_file(logfile, 'old log\n')
+        install.clear_install_log(logfile)
+        self.assertEqual('', load_file(logfile))
+        self.assertEqual('old log\n', load_file(logfile + '.prev'))
+
+    def test_clear_install_log_creates_log(self):
+        """clear_install_log creates the log and its directory."""
+        logfile = self.tmp_path('logs/install.log')
+        install.clear_install_log(logfile)
+        self.assertEqual('', load_file(logfile))
+        self.assertFalse(os.path.exists(logfile + '.prev'))
+
+
+class TestCopyInstallLog(CiTestCase):
+
+    def setUp(self):
+        super(TestCopyInstallLog, self).setUp()
+        self.target = self.tmp_dir()
+        self.logfile = self.tmp_path('install.log')
+
+    def test_copy_install_log_to_target(self):
+        """copy_install_log copies the log into target, read-only."""
+        write_file(self.logfile, 'install log\n')
+        install.copy_install_log(self.logfile, self.target,
+                                 '/root/curtin-install.log')
+        target_log = self.tmp_path('root/curtin-install.log', self.target)
+        self.assertEqual('install log\n', load_file(target_log))
+        self.assertEqual(0o400, os.stat(target_log).st_mode & 0o777)
+
+    @mock.patch('curtin.commands.install.shutil.copyfile')
+    def test_copy_install_log_skips_unchanged_log(self, m_copyfile):
+        """copy_install_log does not copy an unchanged log twice."""
+        m_copyfile.side_effect = lambda src, dst: write_file(dst, 'copy')
+        write_file(self.logfile, 'install log\n')
+        for _ in range(2):
+            install.copy_install_log(self.logfile, self.target,
+                                     '/root/curtin-install.log')
+        self.assertEqual(1, m_copyfile.call_count)
+        write_file(self.logfile, 'more install log\n', omode='a')
+        install.copy_install_log(self.logfile, self.target,
+                                 '/root/curtin-install.log')
+        self.assertEqual(2, m_copyfile.call_count)
+
+    def test_copy_install_log_missing_logfile(self):
+        """copy_install_log does nothing if the log does not exist."""
+        install.copy_install_log(self.logfile, self.target,
+                                 '/root/curtin-install.log')
+        self.assertEqual([], os.listdir(self.target))
+
+
+class TestWriteAll(CiTestCase):
+
+    def test_write_all_retries_short_writes(self):
+        """write_all keeps writing the remainder after a short write."""
+        written = []
+
+        def short_write(data):
+            written.append(data[:3])
+            return len(written[-1])
+
+        fp = mock.Mock()
+        fp.write.side_effect = short_write
+        install.write_all(fp, b'abcdefgh')
+        self.assertEqual([b'abc', b'def', b'gh'], written)
+
+
+class TestWriteline(CiTestCase):
+
+    def test_writeline_to_path(self):
+        """writeline appends a line to the file at the given path."""
+        logfile = self.tmp_path('install.log')
+        write_file(logfile, 'old log\n')
+        install.writeline(logfile, 'new line')
+        self.assertEqual('old log\nnew line\n', load_file(logfile))
+
+    def test_writeline_to_install_log(self):
+        """writeline appends lines through an open InstallLog."""
+        logfile = self.tmp_path('install.log')
+        write_file(logfile, 'old log\n')
+        with install.InstallLog(logfile) as install_log:
+            install.writeline(install_log, 'line 1')
+            install.writeline(install_log, 'line 2\n')
+            self.assertEqual('old log\nline 1\nline 2\n',
+                             load_file(logfile))
+        self.assertIsNone(install_log.fp)
+
+    def test_writeline_to_install_log_non_ascii(self):
+        """writeline writes non-ascii messages through an InstallLog."""
+        logfile = self.tmp_path('install.log')
+        message = install.INSTALL_FAIL_MSG.format(
+            exception=u'E: Unable to locate package \u2018caf\u00e9\u2019')
+        with install.InstallLog(logfile) as install_log:
+            install.writeline(install_log, message)
+            # as on python2, where messages are byte strings
+            install_log.write(message.encode('utf-8') + b'\n')
+        self.assertEqual(2 * (message + u'\n'), load_file(logfile))
+
+    def test_install_log_without_logfile(self):
+        """InstallLog with no logfile ignores writes."""
+        with install.InstallLog(None) as install_log:
+            install.writeline(install_log, 'line 1')
+
+
+class TestDumpJson(CiTestCase):
+
+    cfg = {'sources': {'00_cmdline': {'type': 'tgz', 'uri': 'a.tgz'}},
+           'stages': ['early', 'late'], 'network': {1: 'eth0'},
+           'install': {'unmount': None, 'save_install_log': False}}
+    expected = {'sources': {'00_cmdline': {'type': 'tgz', 'uri': 'a.tgz'}},
+                'stages': ['early', 'late'], 'network': {'1': 'eth0'},
+                'install': {'unmount': None, 'save_install_log': False}}
+
+    @mock.patch('curtin.commands.install.orjson', None)
+    def test_dump_json_without_orjson(self):
+        """dump_json encodes with json when orjson is not available."""
+        self.assertEqual(self.expected,
+                         json.loads(install.dump_json(self.cfg).decode()))
+
+    @mock.patch('curtin.commands.install.orjson', None)
+    def test_dump_json_without_orjson_rejects_dates(self):
+        """dump_json raises TypeError on dates without orjson."""
+        with self.assertRaises(TypeError):
+            install.dump_json({'date': datetime.date(2020, 1, 1)})
+
+    @skipIf(install.orjson is None, "orjson is not installed")
+    def test_dump_json_with_orjson(self):
+        """dump_json with orjson decodes the same as with json."""
+        self.assertEqual(self.expected,
+                         json.loads(install.dump_json(self.cfg).decode()))
+
+    @skipIf(install.orjson is None, "orjson is not installed")
+    def test_dump_json_with_orjson_rejects_dates(self):
+        """dump_json with orjson raises TypeError on dates like json."""
+        with self.assertRaises(TypeError):
+            install.dump_json({'date': datetime.date(2020, 1, 1)})
+
+
 class TestWorkingDir(CiTestCase):
     def test_target_dir_may_exist(self):
         """WorkingDir supports existing empty target directory."""
@@ -229,3 +462,232 @@ class TestWorkingDir(CiTestCase):
             wd = install.WorkingDir({})
         self.assertEqual(1, m_mkdtemp.call_count)
         self.assertTrue(wd.target.startswith(work_d + "/"))
+
+    def test_config_written_as_json(self):
+        """WorkingDir writes config as json to the CONFIG path."""
+        tmp_d = self.tmp_dir()
+        work_d = self.tmp_path("work_d", tmp_d)
+        ensure_dir(work_d)
+        cfg = {'sources': {'00_cmdline': 'http://example.com/root.tgz'},
+               'install': {'unmount': 'disabled'}, 'network': {1: 'eth0'}}
+        with mock.patch("curtin.commands.install.tempfile.mkdtemp",
+                        return_value=work_d):
+            wd = install.WorkingDir(cfg)
+        self.assertEqual(wd.config_file, wd.env().get('CONFIG'))
+        self.assertEqual(dict(cfg, network={'1': 'eth0'}),
+                         json.loads(load_file(wd.config_file)))
+
+
+class TestStage(CiTestCase):
+    with_logs = True
+
+    def setUp(self):
+        super(TestStage, self).setUp()
+        self.logfile = self.tmp_path('install.log')
+
+    def _stage(self, commands, parallel=False):
+        stage = install.Stage('test', commands, {}, logfile=self.logfile,
+                              parallel=parallel)
+        stage.write_stdout = mock.Mock()
+        return stage
+
+    def test_run_writes_command_output_to_log(self):
+        """Stage.run copies all command output to the install log."""
+        stage = self._stage({'cmd1': ['sh', '-c', 'seq 1 20000']})
+        stage.run()
+        stage.install_log.close()
+        expected = ''.join('%d\n' % i for i in range(1, 20001))
+        self.assertEqual(expected, load_file(self.logfile))
+
+    def test_run_sets_reportstack_per_command(self):
+        """Commands get their own CURTIN_REPORTSTACK; env is restored."""
+        env = {'CURTIN_REPORTSTACK': 'stage-test',
+               'PATH': os.environ.get('PATH', '')}
+        stage = install.Stage(
+            'test', {'cmd1': ['sh', '-c', 'echo $CURTIN_REPORTSTACK']}, env,
+            logfile=self.logfile)
+        stage.write_stdout = mock.Mock()
+        stage.run()
+        stage.install_log.close()
+        self.assertEqual('stage-test/cmd1\n', load_file(self.logfile))
+        self.assertEqual('stage-test', env['CURTIN_REPORTSTACK'])
+
+    def test_run_reads_output_of_background_children(self):
+        """Stage.run reads output written after the command has exited."""
+        alive = self.tmp_path('alive')
+        stage = self._stage({'cmd1': [
+            'sh', '-c', '(sleep 0.5; echo late; touch "$1") & echo early',
+            'cmd1', alive]})
+        stage.run()
+        stage.install_log.close()
+        self.assertEqual('early\nlate\n', load_file(self.logfile))
+        self.assertTrue(os.path.exists(alive))
+
+    def test_run_failure_includes_output(self):
+        """Failing commands raise ProcessExecutionError with their output."""
+        stage = self._stage({'cmd1': ['sh', '-c', 'echo hi; exit 3']})
+        with self.assertRaises(ProcessExecutionError) as context_manager:
+            stage.run()
+        self.assertEqual(3, context_manager.exception.exit_code)
+        self.assertIn('hi', context_manager.exception.stdout)
+
+    def test_run_parallel_writes_output_in_sorted_order(self):
+        """Parallel commands' output is logged in sorted command order."""
+        stage = self._stage({'cmd2': ['sh', '-c', 'echo two'],
+                             'cmd1': ['sh', '-c', 'sleep 0.2; echo one'],
+                             'cmd3': None}, parallel=True)
+        stage.run()
+        stage.install_log.close()
+        self.assertEqual('one\ntwo\n', load_file(self.logfile))
+
+    @mock.patch('curtin.commands.install.multiprocessing.cpu_count')
+    def test_run_parallel_runs_commands_concurrently(self, m_cpu_count):
+        """Parallel commands run at the same time."""
+        m_cpu_count.return_value = 4
+        flag = self.tmp_path('flag')
+        wait_for_flag = (
+            'for i in $(seq 100); do [ -e "$1" ] && exit 0; sleep 0.1; done; '
+            'exit 1')
+        stage = self._stage(
+            {'cmd1': ['sh', '-c', wait_for_flag, 'cmd1', flag],
+             'cmd2': ['sh', '-c', 'touch "$1"', 'cmd2', flag]},
+            parallel=True)
+        stage.run()
+
+    def test_run_parallel_raises_first_failure(self):
+        """Parallel stages log all output, then raise the first failure."""
+        stage = self._stage({'cmd1': ['sh', '-c', 'sleep 0.2; exit 2'],
+                             'cmd2': ['sh', '-c', 'echo two; exit 3'],
+                             'cmd3': ['sh', '-c', 'echo three']},
+                            parallel=True)
+        with self.assertRaises(ProcessExecutionError) as context_manager:
+            stage.run()
+        self.assertEqual(2, context_manager.exception.exit_code)
+        stage.install_log.close()
+        self.assertEqual('two\nthree\n', load_file(self.logfile))
+        self.assertIn('cmd2 command also failed', self.logs.getvalue())
+
+
+class TestLoadPowerState(CiTestCase):
+
+    def _delay(self, pstate):
+        return install.load_power_state(pstate)[4]
+
+    def test_no_power_state(self):
+        """load_power_state returns None without power_state config."""
+        self.assertIsNone(install.load_power_state(None))
+
+    def test_delay_values(self):
+        """load_power_state converts delay to a sleep argument."""
+        self.assertEqual('5', self._delay({'mode': 'reboot'}))
+        self.assertEqual('0', self._delay({'mode': 'reboot',
+                                           'delay': 'now'}))
+        self.assertEqual('3m', self._delay({'mode': 'reboot',
+                                            'delay': '+3'}))
+        self.assertEqual('30', self._delay({'mode': 'reboot', 'delay': 30}))
+
+    def test_invalid_mode_raises_type_error(self):
+        """load_power_state raises TypeError on an unknown mode."""
+        with self.assertRaises(TypeError):
+            install.load_power_state({'mode': 'sleep'})
+
+
+class TestApplyKexec(CiTestCase):
+
+    grubcfg = textwrap.dedent("""\
+        set default="1"
+        menuentry 'Ubuntu' --class ubuntu {
+            linux boot/vmlinuz-1 root=/dev/vda1 ro
+            initrd boot/initrd.img-1
+        }
+        menuentry 'Ubuntu, older' --class ubuntu {
+            linux boot/vmlinuz-0 root=/dev/vda1 ro quiet
+            initrd boot/initrd.img-0
+        }
+        """)
+
+    def setUp(self):
+        super(TestApplyKexec, self).setUp()
+        self.target = self.tmp_dir()
+        self.add_patch('curtin.util.which', 'm_which')
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.m_which.return_value = '/sbin/kexec'
+
+    def test_kexec_mode_not_on_does_nothing(self):
+        """apply_kexec returns False when kexec mode is not on."""
+        self.assertFalse(install.apply_kexec({'mode': 'off'}, self.target))
+        self.assertFalse(install.apply_kexec(None, self.target))
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_kexec_not_dict_raises_type_error(self):
+        """apply_kexec raises TypeError if kexec config is not a dict."""
+        with self.assertRaises(TypeError):
+            install.apply_kexec('on', self.target)
+
+    @mock.patch('curtin.distro.install_packages')
+    def test_kexec_missing_grubcfg_raises_before_install(self, m_install):
+        """apply_kexec checks for grub.cfg before installing kexec-tools."""
+        self.m_which.return_value = None
+        with self.assertRaises(ValueError):
+            install.apply_kexec({'mode': 'on'}, self.target)
+        self.assertEqual(0, m_install.call_count)
+
+    def test_kexec_loads_default_menuentry(self):
+        """apply_kexec loads the kernel of the default grub menuentry."""
+        write_file(self.tmp_path('boot/grub/grub.cfg', self.target),
+                   self.grubcfg)
+        self.assertTrue(install.apply_kexec({'mode': 'on'}, self.target))
+        self.m_subp.assert_called_with(args=[
+            'kexec', '-l', self.target + '/boot/vmlinuz-0',
+            '--append=root=/dev/vda1 ro quiet',
+            '--initrd=' + self.target + '/boot/initrd.img-0'])
+
+    def test_kexec_default_out_of_range_uses_first_entry(self):
+        """apply_kexec uses the first entry if the default does not exist."""
+        write_file(self.tmp_path('boot/grub/grub.cfg', self.target),
+                   self.grubcfg.replace('default="1"', 'default="2"'))
+        self.assertTrue(install.apply_kexec({'mode': 'on'}, self.target))
+        self.m_subp.assert_called_with(args=[
+            'kexec', '-l', self.target + '/boot/vmlinuz-1',
+            '--append=root=/dev/vda1 ro',
+            '--initrd=' + self.target + '/boot/initrd.img-1'])
+
+    def test_kexec_default_counts_only_top_level_entries(self):
+        """apply_kexec numbers a submenu as one entry, like grub."""
+        grubcfg = textwrap.dedent("""\
+            set default="2"
+            function load_video {
+                insmod all_video
+            }
+            menuentry 'Ubuntu' --class ubuntu {
+                set root='hd0,gpt2'
+                if [ x$feature_platform_search_hint = xy ]; then
+                  search --no-floppy --fs-uuid --set=root ${uuid}
+                fi
+                linux boot/vmlinuz-1 root=/dev/vda1 ro
+                initrd boot/initrd.img-1
+            }
+            submenu 'Advanced options for Ubuntu' {
+                menuentry 'Ubuntu, with Linux 1' --class ubuntu {
+                    linux boot/vmlinuz-1 root=/dev/vda1 ro single
+                    initrd boot/initrd.img-1
+                }
+            }
+            menuentry 'Ubuntu, older' --class ubuntu {
+                linux boot/vmlinuz-0 root=/dev/vda1 ro quiet
+                initrd boot/initrd.img-0
+            }
+            """)
+        write_file(self.tmp_path('boot/grub/grub.cfg', self.target), grubcfg)
+        self.assertTrue(install.apply_kexec({'mode': 'on'}, self.target))
+        self.m_subp.assert_called_with(args=[
+            'kexec', '-l', self.target + '/boot/vmlinuz-0',
+            '--append=root=/dev/vda1 ro quiet',
+            '--initrd=' + self.target + '/boot/initrd.img-0'])
+
+    def test_kexec_no_menuentry_returns_false(self):
+        """apply_kexec returns False if grub.cfg has no menuentry."""
+        write_file(self.tmp_path('boot/grub/grub.cfg', self.target),
+                   'set default="0"\n')
+        self.assertFalse(install.apply_kexec({'mode': 'on'}, self.target))
+        self.assertEqual(0, self.m_subp.call_count)
@@ -706,6 +706,19 @@ class TestChrootableTargetResolvConf(CiTestCase):
         self.assertEqual(content, target_conf)
 
 
+class TestDirIsEmpty(CiTestCase):
+
+    def test_dir_is_empty_on_empty_dir(self):
+        """dir_is_empty returns True for a directory with no entries."""
+        self.assertTrue(util.dir_is_empty(self.tmp_dir()))
+
+    def test_dir_is_empty_on_populated_dir(self):
+        """dir_is_empty returns False for a directory with entries."""
+        tmp_d = self.tmp_dir()
+        util.ensure_dir(os.path.join(tmp_d, 'subdir'))
+        self.assertFalse(util.dir_is_empty(tmp_d))
+
+
 class TestLoadFile(CiTestCase):
     """Test utility 'load_file'"""
 
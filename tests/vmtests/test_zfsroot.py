@@ -15,12 +15,13 @@ class TestZfsRootAbs(VMBaseClass):
     extra_disks = []
     extra_collect_scripts = [textwrap.dedent("""
             cd OUTPUT_COLLECT_D
-            blkid -o export /dev/vda > blkid_output_vda
+            blkid -o export /dev/vda > blkid_output_vda &
+            cp -a /etc/zfs ./etc_zfs &
             zfs list > zfs_list
             zpool list > zpool_list
             zpool status > zpool_status
             zdb > zdb.output
-            cp -a /etc/zfs ./etc_zfs
+            wait
 
             exit 0
         """)]